@@ -1,16 +1,41 @@
-from openai import OpenAI
-from openai import OpenAIError
+from openai import AsyncOpenAI
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from openai import AuthenticationError, PermissionDeniedError
 from docx import Document
 from docx.shared import Pt
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential, before_sleep_log
 import os
 import logging
-import time
+import asyncio
 import tiktoken
-import json
+import httpx
+import orjson
+import shelve
+import hashlib
+from functools import lru_cache
+from itertools import islice
+from collections import deque
 
 # Set the model name
 MODEL_NAME = 'gpt-4o'
 
+# Tokens reserved for the completion
+MAX_COMPLETION_TOKENS = 4096
+
+# Models that allow longer completions than MAX_COMPLETION_TOKENS
+MODEL_MAX_COMPLETION_TOKENS = {
+    'gpt-4o': 16384,
+    'gpt-4o-mini': 16384,
+}
+
+# Context window sizes of the supported models, in tokens. Only models that support
+# JSON mode (response_format json_object) can be used, which excludes gpt-4 and gpt-4-32k.
+MODEL_CTX = {
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -19,223 +44,528 @@ config_path = os.path.join(script_dir, 'config.json')
 
 # Load the configuration file
 try:
-    with open(config_path, 'r') as config_file:
-        config = json.load(config_file)
+    with open(config_path, 'rb') as config_file:
+        config = orjson.loads(config_file.read())
 except FileNotFoundError:
     raise FileNotFoundError(f"Configuration file not found at {config_path}. Please ensure 'config.json' exists.")
 
-# Initialize the OpenAI client with your API key
-client = OpenAI(api_key=config.get('OPENAI_API_KEY'))
+# Path to the cache of finished chunk translations, so that interrupted runs can be resumed
+cache_path = os.path.join(script_dir, '.translate_cache')
+
+# Initialize the OpenAI client with your API key. Concurrent requests share a pool of
+# HTTP/2 connections, so they are multiplexed instead of opening a connection each.
+client = AsyncOpenAI(
+    api_key=config.get('OPENAI_API_KEY'),
+    max_retries=0,  # Retries are handled by create_completion
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+    ),
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def read_docx(file_path):
     """
-    Reads a .docx file and returns the text as a list of paragraphs.
+    Reads a .docx file and yields the text of its paragraphs.
     """
     doc = Document(file_path)
-    paragraphs = [para.text for para in doc.paragraphs]
-    return paragraphs
+    for para in doc.paragraphs:
+        yield para.text
 
-def estimate_tokens(text, model=MODEL_NAME):
+@lru_cache(maxsize=4)
+def _get_encoding(model):
+    return tiktoken.encoding_for_model(model)
+
+# Look up the tokenizer once for the default model. Text is encoded with encode_ordinary,
+# which skips the special-token check (documents are plain text) and is faster.
+ENCODING = _get_encoding(MODEL_NAME)
+
+def split_text(text_list, max_tokens=2048, encoding=ENCODING, batch_size=1024):
     """
-    Estimates the number of tokens in a text using tiktoken.
+    Splits paragraphs into chunks that fit within the token limit.
+    Yields each chunk as a list of paragraphs as soon as it is complete.
     """
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    text_list = iter(text_list)
+    current_paragraphs = []
+    current_token_count = 0
+    while True:
+        block = list(islice(text_list, batch_size))
+        if not block:
+            break
+        paragraphs = [paragraph for paragraph in block if paragraph.strip() != '']  # Skip empty paragraphs
+        # Encode each block of paragraphs once, in parallel, and keep a running token count for the chunk
+        paragraph_token_ids = encoding.encode_ordinary_batch(
+            [paragraph + '\n' for paragraph in paragraphs],
+            num_threads=os.cpu_count() or 1
+        )
+        for paragraph, token_ids in zip(paragraphs, paragraph_token_ids):
+            if current_paragraphs and current_token_count + len(token_ids) > max_tokens:
+                yield current_paragraphs
+                current_paragraphs = []
+                current_token_count = 0
+            current_paragraphs.append(paragraph)
+            current_token_count += len(token_ids)
+    if current_paragraphs:
+        yield current_paragraphs
+
+# Transient API errors that are worth retrying; other errors (e.g. authentication,
+# permission or invalid request errors) will not succeed on retry and are raised immediately
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# API errors caused by the configuration rather than a chunk; they abort the whole run
+FATAL_ERRORS = (AuthenticationError, PermissionDeniedError)
 
-def split_text(text_list, max_tokens=2048, model=MODEL_NAME):
+_wait_backoff = wait_exponential(multiplier=1)
+
+def _wait_retry_after(retry_state):
     """
-    Splits text into chunks that fit within the token limit.
+    Waits as long as the Retry-After header of a rate limit error asks for, and backs off exponentially otherwise.
     """
-    chunks = []
-    current_chunk = ''
-    for paragraph in text_list:
-        if paragraph.strip() == '':
-            continue  # Skip empty paragraphs
-        # Estimate tokens if we add this paragraph
-        new_chunk = current_chunk + paragraph + '\n'
-        if estimate_tokens(new_chunk, model) > max_tokens:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = paragraph + '\n'
-        else:
-            current_chunk = new_chunk
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
-    return chunks
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass  # Missing, or given as an HTTP date
+    return _wait_backoff(retry_state)
 
-def translate_text(text, previous_translations='', previous_texts='', sample_translation='', source_lang='English', target_lang='Polish', model=MODEL_NAME):
+@retry(
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(5),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.INFO),
+    reraise=True,
+)
+async def create_completion(messages, model=MODEL_NAME, max_tokens=MAX_COMPLETION_TOKENS):
     """
-    Translates text using the OpenAI API, including previous translations and original texts.
+    Sends a chat completion request for a JSON response, retrying on transient API errors.
+    Raises a ValueError if the response was cut off at the completion token limit.
     """
-    # Build the system prompt with detailed instructions
-    system_prompt = (
-        f"You are a professional translator proficient in {source_lang} and {target_lang}."
-        f" Your task is to translate the text with an emphasis on formal equivalence."
-        f" Please preserve the original meaning, style, and sentence structure as closely as possible."
+    response = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.3,
+        response_format={"type": "json_object"},
     )
-    if sample_translation:
-        system_prompt += f"\n\nUse the following sample translation as a style guide:\n\n{sample_translation}\n\n"
-
-    # Build the user prompt
-    prompt = f"Translate the following text from {source_lang} to {target_lang} with emphasis on formal equivalence."
-
-    if previous_texts and previous_translations:
-        prompt += "\n\nPrevious segments for context (original and translation):\n"
-        # Combine previous texts and translations as pairs
-        previous_texts_lines = previous_texts.strip().split('\n')
-        previous_translations_lines = previous_translations.strip().split('\n')
-        previous_pairs = zip(previous_texts_lines, previous_translations_lines)
-        for orig, trans in previous_pairs:
-            prompt += f"\nOriginal: {orig}\nTranslation: {trans}\n"
-
-    prompt += f"\n\nText to translate:\n\n{text}"
-
-    # Ensure total tokens are within limit
-    max_model_tokens = 8192 if '32k' not in model else 32768
-    max_completion_tokens = 4096  # Reserve tokens for the completion
-    max_prompt_tokens = max_model_tokens - max_completion_tokens
-
-    # Estimate tokens
-    total_prompt = system_prompt + '\n\n' + prompt
-    total_tokens = estimate_tokens(total_prompt, model)
-
-    # Truncate previous translations and texts if necessary
-    encoding = tiktoken.encoding_for_model(model)
-    while total_tokens > max_prompt_tokens:
-        if previous_texts and previous_translations:
-            # Remove the oldest pair
-            previous_texts_lines = previous_texts.strip().split('\n')
-            previous_translations_lines = previous_translations.strip().split('\n')
-            if len(previous_texts_lines) > 1 and len(previous_translations_lines) > 1:
-                previous_texts = '\n'.join(previous_texts_lines[1:])
-                previous_translations = '\n'.join(previous_translations_lines[1:])
-            else:
-                # Can't reduce previous context further
-                previous_texts = ''
-                previous_translations = ''
-        else:
+    choice = response.choices[0]
+    if choice.finish_reason == 'length':
+        raise ValueError(f"Translation was cut off at the limit of {max_tokens} completion tokens.")
+    return choice.message.content
+
+def parse_translations(content, paragraph_count):
+    """
+    Parses the list of translated paragraphs from a JSON response.
+    Raises a ValueError if the response is not a list of exactly paragraph_count strings.
+    """
+    response = orjson.loads(content)
+    translations = response.get('translations') if isinstance(response, dict) else None
+    if not isinstance(translations, list) or not all(isinstance(translation, str) for translation in translations):
+        raise ValueError("Response does not contain a list of translated paragraphs.")
+    if len(translations) != paragraph_count:
+        raise ValueError(f"Expected {paragraph_count} translated paragraphs, but got {len(translations)}.")
+    return [translation.strip() for translation in translations]
+
+class Translator:
+    """
+    Translates the chunks of a document. The prompt parts that are the same for
+    every chunk, and their token counts, are built once when the translator is created.
+    If a cache (a dict-like object such as a shelve) is given, finished translations are
+    stored in it, keyed by a hash of the prompt, and reused instead of calling the API again.
+    """
+
+    def __init__(self, sample_translation='', source_lang='English', target_lang='Polish', model=MODEL_NAME, encoding=None, cache=None):
+        self.model = model
+        self.cache = cache
+        if encoding is None:
+            encoding = _get_encoding(model)  # Count tokens with the tokenizer of the model
+        self.encoding = encoding
+
+        # Build the system prompt with detailed instructions
+        self.system_prompt = (
+            f"You are a professional translator proficient in {source_lang} and {target_lang}."
+            f" Your task is to translate the text with an emphasis on formal equivalence."
+            f" Please preserve the original meaning, style, and sentence structure as closely as possible."
+            f"\n\nThe text to translate is given as a JSON object of the form {{\"paragraphs\": [...]}}."
+            f" Respond with a JSON object of the form {{\"translations\": [...]}}, containing the translation of each paragraph"
+            f" in the same order, with exactly as many elements as there are paragraphs."
+        )
+        if sample_translation:
+            self.system_prompt += f"\n\nUse the following sample translation as a style guide:\n\n{sample_translation}\n\n"
+
+        # Fixed parts of the user prompt, kept as token ids
+        prompt_header = f"Translate the following text from {source_lang} to {target_lang} with emphasis on formal equivalence."
+        self.prompt_header_ids = encoding.encode_ordinary(prompt_header)
+        self.context_header_ids = encoding.encode_ordinary("\n\nPrevious segments for context (original and translation):\n")
+        self.text_header_ids = encoding.encode_ordinary("\n\nParagraphs to translate:\n\n")
+        # The paragraphs are sent as {"paragraphs": [...]}, assembled from these parts
+        self.payload_open_ids = encoding.encode_ordinary('{"paragraphs": [')
+        self.payload_separator_ids = encoding.encode_ordinary(', ')
+        self.payload_close_ids = encoding.encode_ordinary(']}')
+
+        # Token limits and the token counts of the fixed parts
+        if model not in MODEL_CTX:
+            raise ValueError(f"Unknown context window size for model '{model}'. Please add it to MODEL_CTX.")
+        self.max_completion_tokens = MODEL_MAX_COMPLETION_TOKENS.get(model, MAX_COMPLETION_TOKENS)
+        self.max_prompt_tokens = MODEL_CTX[model] - self.max_completion_tokens
+        self.system_prompt_tokens = len(encoding.encode_ordinary(self.system_prompt + '\n\n'))
+        # User prompt tokens excluding the previous pairs and the paragraphs
+        self.prompt_skeleton_tokens = (
+            len(self.prompt_header_ids) + len(self.text_header_ids)
+            + len(self.payload_open_ids) + len(self.payload_close_ids)
+        )
+
+    def build_messages(self, paragraphs, previous_pairs=()):
+        """
+        Builds the chat messages for translating a list of paragraphs,
+        including previous (original, translation) pairs as context.
+        Returns the messages and the number of paragraphs they contain, which is
+        smaller than len(paragraphs) if the text had to be truncated.
+        """
+        encoding = self.encoding
+
+        # Tokenize each variable part once; token counts are taken from the token ids,
+        # and the user prompt is decoded from them only once at the end
+        pair_ids = [encoding.encode_ordinary(f"\nOriginal: {orig}\nTranslation: {trans}\n") for orig, trans in previous_pairs]
+        paragraph_ids = [encoding.encode_ordinary(orjson.dumps(paragraph).decode('utf-8')) for paragraph in paragraphs]
+        separator_tokens = len(self.payload_separator_ids)
+
+        # Estimate tokens
+        context_tokens = len(self.context_header_ids) + sum(len(ids) for ids in pair_ids) if pair_ids else 0
+        text_tokens = sum(len(ids) for ids in paragraph_ids) + separator_tokens * max(len(paragraph_ids) - 1, 0)
+        total_tokens = self.system_prompt_tokens + self.prompt_skeleton_tokens + context_tokens + text_tokens
+
+        # Drop the oldest previous pairs if necessary, subtracting their tokens from the total
+        first_pair = 0
+        while total_tokens > self.max_prompt_tokens and first_pair < len(pair_ids):
+            total_tokens -= len(pair_ids[first_pair])
+            first_pair += 1
+            if first_pair == len(pair_ids):
+                total_tokens -= len(self.context_header_ids)
+
+        if total_tokens > self.max_prompt_tokens:
             # Need to truncate the text
             logging.warning("Prompt is too long even without previous translations. Truncating text.")
-            text_token_ids = encoding.encode(text)
-            allowed_text_tokens = max_prompt_tokens - estimate_tokens(system_prompt + '\n\n' + prompt.replace(text, ''), model)
-            if allowed_text_tokens > 0:
-                # Truncate text
-                text = encoding.decode(text_token_ids[:allowed_text_tokens])
-                # Rebuild prompt
-                prompt = f"Translate the following text from {source_lang} to {target_lang} with emphasis on formal equivalence."
-                if previous_texts and previous_translations:
-                    prompt += "\n\nPrevious segments for context (original and translation):\n"
-                    previous_pairs = zip(previous_texts.strip().split('\n'), previous_translations.strip().split('\n'))
-                    for orig, trans in previous_pairs:
-                        prompt += f"\nOriginal: {orig}\nTranslation: {trans}\n"
-                prompt += f"\n\nText to translate:\n\n{text}"
-                total_prompt = system_prompt + '\n\n' + prompt
-                total_tokens = estimate_tokens(total_prompt, model)
-            else:
+            allowed_text_tokens = self.max_prompt_tokens - self.system_prompt_tokens - self.prompt_skeleton_tokens
+            if allowed_text_tokens <= 0:
                 raise ValueError("Text to translate is too long to fit into the prompt.")
-        # Recalculate total tokens
-        total_prompt = system_prompt + '\n\n' + prompt
-        total_tokens = estimate_tokens(total_prompt, model)
+            # Keep the paragraphs that fit, and cut the first one that does not
+            kept_paragraph_ids = []
+            for paragraph, ids in zip(paragraphs, paragraph_ids):
+                if kept_paragraph_ids:
+                    allowed_text_tokens -= separator_tokens
+                if len(ids) > allowed_text_tokens:
+                    # Cut the raw text, then shorten the cut until its escaped JSON literal fits,
+                    # since quotes, backslashes and newlines take extra tokens once escaped
+                    raw_ids = encoding.encode_ordinary(paragraph)
+                    cut = allowed_text_tokens
+                    while cut > 0:
+                        truncated = encoding.decode(raw_ids[:cut])
+                        truncated_ids = encoding.encode_ordinary(orjson.dumps(truncated).decode('utf-8'))
+                        if len(truncated_ids) <= allowed_text_tokens:
+                            kept_paragraph_ids.append(truncated_ids)
+                            break
+                        # Shrink the cut in proportion to how far the escaped literal overshoots
+                        cut = min(cut - 1, cut * allowed_text_tokens // len(truncated_ids))
+                    break
+                kept_paragraph_ids.append(ids)
+                allowed_text_tokens -= len(ids)
+            paragraph_ids = kept_paragraph_ids
 
-    # API call with error handling and retries
-    max_retries = 5
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=max_completion_tokens,
-                temperature=0.3,
-            )
-            translated_text = response.choices[0].message.content
-            return translated_text.strip()
-        except OpenAIError as e:
-            logging.error(f"OpenAI API error: {e}")
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                logging.info(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
+        # Assemble the user prompt
+        prompt_ids = list(self.prompt_header_ids)
+        if first_pair < len(pair_ids):
+            prompt_ids += self.context_header_ids
+            for ids in pair_ids[first_pair:]:
+                prompt_ids += ids
+        prompt_ids += self.text_header_ids + self.payload_open_ids
+        for idx, ids in enumerate(paragraph_ids):
+            if idx:
+                prompt_ids += self.payload_separator_ids
+            prompt_ids += ids
+        prompt_ids += self.payload_close_ids
+        prompt = encoding.decode(prompt_ids)
+
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": prompt}
+        ]
+        return messages, len(paragraph_ids)
+
+    def cache_key(self, messages):
+        """
+        Returns the cache key for a request: a hash of the model and the prompts.
+        """
+        key_text = self.model + '\n' + messages[0]['content'] + '\n\n' + messages[1]['content']
+        return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+    async def translate_chunk(self, paragraphs, previous_pairs=()):
+        """
+        Translates a list of paragraphs in a single API call, including previous (original, translation) pairs as context.
+        Returns the list of translated paragraphs.
+        """
+        messages, paragraph_count = self.build_messages(paragraphs, previous_pairs)
+        key = self.cache_key(messages)
+        if self.cache is not None and key in self.cache:
+            return self.cache[key]
+        # API call with error handling and retries
+        translated_text = await create_completion(messages, model=self.model, max_tokens=self.max_completion_tokens)
+        translations = parse_translations(translated_text, paragraph_count)
+        if self.cache is not None:
+            self.cache[key] = translations
+        return translations
+
+    async def translate_batch(self, chunks, poll_interval=60):
+        """
+        Translates chunks (lists of paragraphs) using the OpenAI Batch API.
+        Returns the lists of translated paragraphs in chunk order, with None for chunks that failed.
+        """
+        # Serialize one chat completion request per chunk that is not cached yet; previous
+        # translations are not available since the requests are processed independently
+        translations = []
+        request_lines = []
+        paragraph_counts = []
+        cache_keys = []
+        for idx, chunk in enumerate(chunks):
+            messages, paragraph_count = self.build_messages(chunk)
+            key = self.cache_key(messages)
+            paragraph_counts.append(paragraph_count)
+            cache_keys.append(key)
+            if self.cache is not None and key in self.cache:
+                translations.append(self.cache[key])
+                continue
+            translations.append(None)
+            request_lines.append(orjson.dumps({
+                "custom_id": f"chunk_{idx}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": messages,
+                    "max_tokens": self.max_completion_tokens,
+                    "temperature": 0.3,
+                    "response_format": {"type": "json_object"},
+                },
+            }))
+        if not request_lines:
+            logging.info("All chunks were found in the cache.")
+            return translations
+
+        # Resume the batch for exactly these requests if an earlier run already created it,
+        # instead of uploading and paying for the same batch again
+        batch_input_data = b'\n'.join(request_lines)
+        batch_key = 'batch_' + hashlib.sha256(batch_input_data).hexdigest()
+        batch = None
+        if self.cache is not None and batch_key in self.cache:
+            batch = await client.batches.retrieve(self.cache[batch_key]['id'])
+            if batch.status in ('failed', 'expired', 'cancelled'):
+                logging.warning(f"Previous batch {batch.id} ended with status '{batch.status}'. Creating a new batch.")
+                batch = None
             else:
+                logging.info(f"Resuming batch {batch.id}.")
+
+        if batch is None:
+            # Upload the requests and start the batch
+            batch_input = await client.files.create(
+                file=('batch_input.jsonl', batch_input_data),
+                purpose='batch'
+            )
+            batch = await client.batches.create(
+                input_file_id=batch_input.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            logging.info(f"Created batch {batch.id} with {len(request_lines)} requests.")
+            if self.cache is not None:
+                # Remember the batch and the cache key of each of its requests
+                self.cache[batch_key] = {
+                    'id': batch.id,
+                    'cache_keys': {f"chunk_{idx}": cache_keys[idx] for idx, translated_chunk in enumerate(translations) if translated_chunk is None},
+                }
+                if hasattr(self.cache, 'sync'):
+                    self.cache.sync()
+
+        # Poll until the batch is done
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            await asyncio.sleep(poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+            logging.info(f"Batch {batch.id} status: {batch.status}")
+        if batch.status != 'completed':
+            if self.cache is not None:
+                del self.cache[batch_key]
+            raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'.")
+
+        # Download the results and restore chunk order by custom_id
+        batch_cache_keys = self.cache[batch_key]['cache_keys'] if self.cache is not None else {}
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            for line in output.content.splitlines():
+                if not line.strip():
+                    continue
+                result = orjson.loads(line)
+                response = result.get('response')
+                if result.get('error') or not response or response['status_code'] != 200:
+                    continue
+                idx = int(result['custom_id'].split('_')[1])
+                try:
+                    choice = response['body']['choices'][0]
+                    if choice.get('finish_reason') == 'length':
+                        raise ValueError(f"Translation was cut off at the limit of {self.max_completion_tokens} completion tokens.")
+                    translations[idx] = parse_translations(choice['message']['content'], paragraph_counts[idx])
+                    if self.cache is not None:
+                        self.cache[batch_cache_keys[result['custom_id']]] = translations[idx]
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    logging.error(f"Invalid response for chunk {idx+1}: {e}")
+        if self.cache is not None:
+            # The results are now cached per chunk, so the batch is not needed anymore
+            del self.cache[batch_key]
+        for idx, translated_chunk in enumerate(translations):
+            if translated_chunk is None:
+                logging.error(f"Failed to translate chunk {idx+1} in batch {batch.id}.")
+        return translations
+
+async def translate_chunks(chunks, translator, use_context=True, max_workers=8):
+    """
+    Translates chunks concurrently with regular API calls, using the given Translator.
+    Yields the translations in chunk order as soon as they are done, with None for chunks that failed.
+    """
+    semaphore = asyncio.Semaphore(max_workers)  # Cap concurrent requests to respect rate limits
+
+    async def translate_chunk(idx, chunk, previous_pairs=()):
+        async with semaphore:
+            logging.info(f"Translating chunk {idx+1}...")
+            try:
+                return await translator.translate_chunk(paragraphs=chunk, previous_pairs=previous_pairs)
+            except FATAL_ERRORS:
                 raise
-        except Exception as e:
-            logging.error(f"An unexpected error occurred: {e}")
-            raise
+            except Exception as e:
+                logging.error(f"Failed to translate chunk {idx+1}: {e}")
+                return None
+
+    if not use_context:
+        # Without context, every chunk is independent; keep a few more chunks in flight
+        # than can be sent at once, and yield them in order as they finish
+        pending = deque()
+        try:
+            for idx, chunk in enumerate(chunks):
+                pending.append(asyncio.ensure_future(translate_chunk(idx, chunk)))
+                if len(pending) >= 2 * max_workers:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # Don't leave requests running if the translation was aborted
+            for task in pending:
+                task.cancel()
+        return
 
-def write_docx(paragraphs, output_path):
+    # Translate windows of chunks concurrently; each window uses the previous windows as context
+    max_previous_segments = 5  # Adjust based on your preference
+    # Keeps only the last few (original, translation) paragraph pairs
+    previous_pairs = deque(maxlen=max_previous_segments)
+    window_size = max_workers  # Number of chunks translated concurrently with the same context
+    chunks = iter(chunks)
+    start = 0
+    while True:
+        window = list(islice(chunks, window_size))
+        if not window:
+            break
+        results = await asyncio.gather(*[
+            translate_chunk(start + offset, chunk, previous_pairs)
+            for offset, chunk in enumerate(window)
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result  # Only fatal errors are raised by translate_chunk
+        for chunk, translated_chunk in zip(window, results):
+            if translated_chunk is not None:
+                # Update previous texts and translations
+                previous_pairs.extend(zip(chunk, translated_chunk))
+            yield translated_chunk
+        start += len(window)
+
+def create_docx():
     """
-    Writes a list of paragraphs to a .docx file.
+    Creates an empty .docx document for the translated paragraphs.
     """
     doc = Document()
+    # Paragraphs use the shared 'Normal' style, so its font only needs to be set once
+    style = doc.styles['Normal']
+    style.font.name = 'Calibri'
+    style.font.size = Pt(12)
+    return doc
+
+def add_paragraphs(doc, paragraphs):
+    """
+    Appends a list of paragraphs to a .docx document.
+    """
     for para in paragraphs:
         if para.strip() == '':
             doc.add_paragraph()
         else:
-            doc_para = doc.add_paragraph(para)
-            doc_para.style.font.name = 'Calibri'
-            doc_para.style.font.size = Pt(12)
-    doc.save(output_path)
+            doc.add_paragraph(para)
 
-def main(input_file, output_file, sample_translation_file=None):
+async def main(input_file, output_file, sample_translation_file=None, sync=False, use_context=True, max_workers=8, resume=True):
     # Step 1: Read the original document
     logging.info(f"Reading input file: {input_file}")
-    original_paragraphs = read_docx(input_file)
+    original_paragraphs = read_docx(input_file)  # Paragraphs are read lazily while splitting
 
     # Step 2: Read the sample translation if provided
     sample_translation = ''
     if sample_translation_file and os.path.exists(sample_translation_file):
         logging.info(f"Reading sample translation file: {sample_translation_file}")
-        sample_paragraphs = read_docx(sample_translation_file)
-        sample_translation = '\n'.join(sample_paragraphs)
+        sample_translation = '\n'.join(read_docx(sample_translation_file))
 
-    # Step 3: Split the text into chunks
-    logging.info("Splitting text into chunks...")
+    # Step 3: Split the text into chunks (lazily, as they are translated)
     # Adjust max_tokens for chunks, considering the token limits and the amount of context
     chunk_max_tokens = 2048  # You can adjust this value
     text_chunks = split_text(original_paragraphs, max_tokens=chunk_max_tokens)
 
-    # Step 4: Translate each chunk with context
-    translated_paragraphs = []
-    previous_translations = ''
-    previous_texts = ''
-    max_previous_segments = 5  # Adjust based on your preference
-    for idx, chunk in enumerate(text_chunks):
-        logging.info(f"Translating chunk {idx+1}/{len(text_chunks)}...")
-        try:
-            translated_chunk = translate_text(
-                text=chunk,
-                previous_translations=previous_translations,
-                previous_texts=previous_texts,
-                sample_translation=sample_translation
-            )
-        except Exception as e:
-            logging.error(f"Failed to translate chunk {idx+1}: {e}")
-            continue
-        # Update previous texts and translations
-        previous_texts += '\n' + chunk
-        previous_translations += '\n' + translated_chunk
-        # Keep only the last few segments
-        previous_texts_lines = previous_texts.strip().split('\n')
-        previous_translations_lines = previous_translations.strip().split('\n')
-        if len(previous_texts_lines) > max_previous_segments:
-            previous_texts = '\n'.join(previous_texts_lines[-max_previous_segments:])
-            previous_translations = '\n'.join(previous_translations_lines[-max_previous_segments:])
-        # Add the translated paragraphs to the list
-        translated_chunk_paragraphs = translated_chunk.strip().split('\n')
-        translated_paragraphs.extend(translated_chunk_paragraphs)
-    # Step 5: Write the translated text to a new document
+    # Step 4: Write each translated chunk to the output document as soon as it is done.
+    # The document is saved every few chunks, and whenever the translation stops.
     logging.info(f"Writing translated text to output file: {output_file}")
-    write_docx(translated_paragraphs, output_file)
+    doc = create_docx()
+    save_every = 10  # Number of translated chunks between saves
+    chunks_written = 0
+
+    def write_chunk(translated_chunk):
+        nonlocal chunks_written
+        if translated_chunk is None:
+            return
+        add_paragraphs(doc, translated_chunk)
+        chunks_written += 1
+        if chunks_written % save_every == 0:
+            doc.save(output_file)
+
+    # Step 5: Translate the chunks, reusing cached translations from previous runs
+    # unless resume is False (in which case the cache is cleared)
+    try:
+        with shelve.open(cache_path, flag='c' if resume else 'n') as cache:
+            translator = Translator(sample_translation=sample_translation, cache=cache)
+            if sync:
+                async for translated_chunk in translate_chunks(text_chunks, translator, use_context=use_context, max_workers=max_workers):
+                    write_chunk(translated_chunk)
+            else:
+                # Submit all chunks as a single Batch API job (cheaper, but can take up to 24 hours)
+                logging.info("Translating chunks with the Batch API...")
+                for translated_chunk in await translator.translate_batch(text_chunks):
+                    write_chunk(translated_chunk)
+    finally:
+        # Don't create or overwrite the output file if nothing was translated
+        if chunks_written > 0:
+            doc.save(output_file)
+    if chunks_written == 0:
+        logging.error(f"No chunks were translated; '{output_file}' was not written.")
+        return
     logging.info(f"Translation completed. The translated document is saved as '{output_file}'.")
 
 if __name__ == "__main__":
     # Replace 'input.docx' with your input file path,
     # 'output.docx' with your desired output file path,
     # and 'sample_translation.docx' with the path to your sample translation (optional)
-    # main('input.docx', 'output.docx', sample_translation_file='sample_translation.docx')
-    main('source.docx', 'translation.docx')
+    # asyncio.run(main('input.docx', 'output.docx', sample_translation_file='sample_translation.docx'))
+    asyncio.run(main('source.docx', 'translation.docx'))